@@ -1,24 +1,61 @@
 import logging
 
-from pymongo.errors import DuplicateKeyError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
+from utils.cleaning_data import email_lookup_keys, phone_lookup_keys
 
-async def insert_or_update_document(collection, filter_dict, update_dict):
+
+def build_update_op(filter_dict, update_dict):
+    return UpdateOne(filter_dict, {"$set": update_dict}, upsert=True)
+
+
+async def bulk_upsert_documents(collection, operations):
+    if not operations:
+        return
     try:
-        result = await collection.update_one(
-            filter_dict, {"$set": update_dict}, upsert=True
+        result = await collection.bulk_write(operations, ordered=False)
+        logging.info(
+            f"Upserted {result.upserted_count} and updated {result.modified_count} "
+            f"documents in {collection.name}"
         )
-        if result.upserted_id:
-            logging.info(
-                f"Inserted new document in {collection.name}: {result.upserted_id}"
-            )
-        else:
-            logging.info(
-                f"Updated existing document in {collection.name}: {filter_dict}"
-            )
-    except DuplicateKeyError:
+    except BulkWriteError as e:
         logging.warning(
-            f"Duplicate key error for document in {collection.name}: {filter_dict}"
+            f"Bulk write errors for documents in {collection.name}: "
+            f"{e.details.get('writeErrors')}"
         )
     except Exception as e:
-        logging.error(f"Error inserting/updating document in {collection.name}: {e}")
+        logging.error(f"Error bulk upserting documents in {collection.name}: {e}")
+
+
+async def backfill_lookup_keys(collection):
+    """Add email_keys/phone_keys to persons stored before extraction wrote them.
+
+    The sheet updaters match on these arrays only, so this runs before their
+    lookups; it's a no-op once every person has them.
+    """
+    cursor = collection.find(
+        {
+            "$or": [
+                {"email_keys": {"$exists": False}},
+                {"phone_keys": {"$exists": False}},
+            ]
+        },
+        {"email": 1, "phone_number": 1},
+    )
+    operations = [
+        build_update_op(
+            {"_id": doc["_id"]},
+            {
+                "email_keys": email_lookup_keys(doc.get("email")),
+                "phone_keys": phone_lookup_keys(doc.get("phone_number")),
+            },
+        )
+        async for doc in cursor
+    ]
+    if operations:
+        logging.info(
+            f"Backfilling lookup keys for {len(operations)} documents "
+            f"in {collection.name}"
+        )
+        await bulk_upsert_documents(collection, operations)
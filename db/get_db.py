@@ -1,8 +1,24 @@
+import atexit
+
 from motor.motor_asyncio import AsyncIOMotorClient
 
 from config.global_variables import MONGO_URI, DB_NAME
 
+# One client (and connection pool) shared by every module in the process
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = AsyncIOMotorClient(
+            MONGO_URI,
+            maxPoolSize=20,
+            minPoolSize=5,
+        )
+        atexit.register(_client.close)
+    return _client
+
 
-async def get_database():
-    client = AsyncIOMotorClient(MONGO_URI)
-    return client[DB_NAME]
+def get_database():
+    return get_client()[DB_NAME]
@@ -1,17 +1,20 @@
+import asyncio
 import logging
-from datetime import datetime
-import pytz
-from pymongo import MongoClient
 
 from utils.cleaning_data import clean_email, clean_phone
 from config.global_variables import (
     SPREADSHEET_NAME,
     DIGISHEET_WORKSHEET_NAME,
-    MONGO_URI,
-    DB_NAME,
     PERSONS_COLLECTION,
 )
-from init_google_sheets.gs_service import initialize_services, get_sheet_id
+from db.get_db import get_database
+from db.data_access_layer import backfill_lookup_keys
+from init_google_sheets.gs_service import (
+    initialize_services,
+    get_sheet_id,
+    coalesce_row_ranges,
+    sheet_timestamp,
+)
 from config.global_variables import LOG_FILE_PATH
 
 # Logging setup
@@ -24,33 +27,57 @@ logging.basicConfig(
 )
 
 
-def load_mongodb_data():
-    """Load data from MongoDB persons collection into dictionaries."""
-    client = MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    collection = db[PERSONS_COLLECTION]
-
-    email_dict = {}
-    phone_dict = {}
-
-    for doc in collection.find():
-        email = clean_email(doc.get("email"))
-        phone = clean_phone(doc.get("phone_number"))
-        updated_at = datetime.strptime(doc.get("updated_at", ""), "%Y-%m-%d %H:%M:%S")
+# Only the fields search_data reads, plus the lookup keys used for deduping
+PROJECTION = {
+    "_id": 0,
+    "email_keys": 1,
+    "phone_keys": 1,
+    "updated_at": 1,
+    # Documents written before stage_status became a plain string still hold
+    # {"value", "description"}; unwrap those on the server
+    "stage_status": {"$ifNull": ["$stage_status.description", "$stage_status"]},
+    "won_lost": 1,
+    "assigned_to": 1,
+}
+MATCH_FIELDS = {
+    "stage_status": "$stage_status",
+    "won_lost": "$won_lost",
+    "assigned_to": "$assigned_to",
+}
+
+
+async def ensure_indexes(collection, backfill_keys=True):
+    """Create the email/phone lookup indexes, backfilling lookup keys if asked."""
+    tasks = [
+        collection.create_index([("email_keys", 1), ("updated_at", -1)]),
+        collection.create_index([("phone_keys", 1), ("updated_at", -1)]),
+    ]
+    if backfill_keys:
+        tasks.append(backfill_lookup_keys(collection))
+    await asyncio.gather(*tasks)
+
+
+async def newest_by_key(collection, key_field, keys):
+    """Resolve the most recently updated person for each key on the server."""
+    pipeline = [
+        {"$match": {key_field: {"$in": keys}}},
+        {"$project": PROJECTION},
+        {"$unwind": f"${key_field}"},
+        {"$match": {key_field: {"$in": keys}}},
+        {"$sort": {"updated_at": -1}},
+        # Keep only the fields shown on the sheet, not the whole document
+        {"$group": {"_id": f"${key_field}", "doc": {"$first": MATCH_FIELDS}}},
+    ]
+    cursor = collection.aggregate(pipeline, batchSize=1000)
+    return {entry["_id"]: entry["doc"] async for entry in cursor}
 
-        if email:
-            if email not in email_dict or updated_at > email_dict[email]["updated_at"]:
-                email_dict[email] = {
-                    "data": doc,
-                    "updated_at": updated_at,
-                }
 
-        if phone:
-            if phone not in phone_dict or updated_at > phone_dict[phone]["updated_at"]:
-                phone_dict[phone] = {
-                    "data": doc,
-                    "updated_at": updated_at,
-                }
+async def fetch_matches(collection, emails, phones):
+    """Fetch the newest MongoDB person for each of the given emails and phones."""
+    email_dict, phone_dict = await asyncio.gather(
+        newest_by_key(collection, "email_keys", list(emails)),
+        newest_by_key(collection, "phone_keys", list(phones)),
+    )
 
     logging.info(
         f"Loaded {len(email_dict)} email records and {len(phone_dict)} phone records from MongoDB"
@@ -61,49 +88,47 @@ def load_mongodb_data():
 def search_data(sheet_data, email_data, phone_data):
     """Search for matches in the loaded MongoDB data."""
     results = []
-    for row_data in sheet_data:
-        email = row_data.get("email")
-        phone = row_data.get("phone_number")
-
-        match = None
-        if email and email in email_data:
-            match = email_data[email]["data"]
-            logging.info(f"Match found in email data for email: {email}")
-        elif phone and phone in phone_data:
-            match = phone_data[phone]["data"]
-            logging.info(f"Match found in phone data for phone: {phone}")
-        else:
-            logging.info(f"No match found for email: {email}, phone: {phone}")
-
-        if match:
-            results.append(
+    # Bound once; these run for every sheet row
+    results_append = results.append
+    email_data_get = email_data.get
+    phone_data_get = phone_data.get
+    matches_found = 0
+    for row, email, phone in sheet_data:
+        match = email_data_get(email) if email else None
+        if match is None and phone:
+            match = phone_data_get(phone)
+
+        if match is not None:
+            matches_found += 1
+            logging.debug("Match found for email: %s, phone: %s", email, phone)
+            results_append(
                 {
-                    "row": row_data["row"],
-                    "stage_status": extract_description(match.get("stage_status", "")),
-                    "won/lost": extract_description(match.get("won_lost", "")),
-                    "assigned_to": extract_description(match.get("assigned_to", "")),
+                    "row": row,
+                    "stage_status": match.get("stage_status") or "",
+                    "won/lost": match.get("won_lost") or "",
+                    "assigned_to": match.get("assigned_to") or "",
                 }
             )
         else:
-            results.append(
+            logging.debug("No match found for email: %s, phone: %s", email, phone)
+            results_append(
                 {
-                    "row": row_data["row"],
+                    "row": row,
                     "stage_status": "N/A",
                     "won/lost": "N/A",
                     "assigned_to": "N/A",
                 }
             )
 
+    logging.info(
+        "Search: %d rows, %d matched, %d missed",
+        len(results),
+        matches_found,
+        len(results) - matches_found,
+    )
     return results
 
 
-def extract_description(value):
-    """Extract description from complex structures or return the value as is."""
-    if isinstance(value, dict):
-        return value.get("description", str(value))
-    return str(value) if value is not None else ""
-
-
 def batch_get_values(service, spreadsheet_id, ranges):
     """Batch get values from multiple ranges in the sheet."""
     request = (
@@ -117,57 +142,62 @@ def batch_get_values(service, spreadsheet_id, ranges):
 def update_sheet_with_results(sheets_service, sheet_id, worksheet_name, results):
     """Update the Google Sheet with the search results."""
     logging.info("Updating sheet with results")
-    now = datetime.now(tz=pytz.utc).astimezone(pytz.timezone("US/Pacific"))
-    dt_string = now.strftime("%m/%d/%Y %H:%M:%S")
-
-    batch_data = []
-    for result in results:
-        row_index = result["row"]
-        values = [
-            dt_string,
-            result["stage_status"],
-            result["won/lost"],
-            result["assigned_to"],
-        ]
-        values = [str(value) for value in values]  # Ensure all values are strings
-        batch_data.append(
-            {
-                "range": f"'{worksheet_name}'!A{row_index}:D{row_index}",
-                "values": [values],
-            }
+    dt_string = sheet_timestamp()
+
+    rows = [
+        (
+            result["row"],
+            [
+                dt_string,
+                str(result["stage_status"]),
+                str(result["won/lost"]),
+                str(result["assigned_to"]),
+            ],
         )
+        for result in results
+    ]
+
+    # Consecutive rows share a single range to keep the request small
+    batch_data = coalesce_row_ranges(worksheet_name, "A", "D", rows)
 
     if batch_data:
         body = {"valueInputOption": "RAW", "data": batch_data}
         sheets_service.spreadsheets().values().batchUpdate(
             spreadsheetId=sheet_id, body=body
         ).execute()
-        logging.info(f"Updated {len(batch_data)} rows with new data")
+        logging.info(
+            f"Updated {len(rows)} rows with new data in {len(batch_data)} ranges"
+        )
     else:
         logging.info("No updates to perform")
 
 
-def main():
+async def main(backfill_keys=True):
     logging.info("Starting script execution")
 
     # Initialize services
     sheets_service, drive_service = initialize_services()
 
     # Get sheet ID
-    sheet_id = get_sheet_id(drive_service, SPREADSHEET_NAME)
+    sheet_id = await asyncio.to_thread(get_sheet_id, drive_service, SPREADSHEET_NAME)
 
-    # Load data from MongoDB
-    email_data, phone_data = load_mongodb_data()
-
-    # Batch get values from the sheet
+    # Batch get values from the sheet while the lookup indexes are ensured
+    # (the Sheets client is blocking, so it runs in a worker thread)
+    db = get_database()
+    collection = db[PERSONS_COLLECTION]
     ranges = [
         f"'{DIGISHEET_WORKSHEET_NAME}'!A2:G",
         f"'{DIGISHEET_WORKSHEET_NAME}'!K2:K",
     ]
-    batch_data = batch_get_values(sheets_service, sheet_id, ranges)
+    _, batch_data = await asyncio.gather(
+        ensure_indexes(collection, backfill_keys),
+        asyncio.to_thread(batch_get_values, sheets_service, sheet_id, ranges),
+    )
 
-    # Process sheet data
+    # Process sheet data, collecting the lookup keys in the same pass
     sheet_data = []
+    emails_to_lookup = set()
+    phones_to_lookup = set()
     if len(batch_data) >= 2:
         emails = batch_data[0].get("values", [])
         phones = batch_data[1].get("values", [])
@@ -177,26 +207,33 @@ def main():
             phone = clean_phone(phone_row[0]) if phone_row else None
 
             if email or phone:
-                sheet_data.append(
-                    {
-                        "row": i,
-                        "email": email,
-                        "phone_number": phone,
-                    }
-                )
+                sheet_data.append((i, email, phone))
+                if email:
+                    emails_to_lookup.add(email)
+                if phone:
+                    phones_to_lookup.add(phone)
 
     logging.info(f"Processed {len(sheet_data)} rows from the sheet")
 
+    # Load only the MongoDB persons referenced by the sheet
+    email_data, phone_data = await fetch_matches(
+        collection, emails_to_lookup, phones_to_lookup
+    )
+
     # Search for matches in MongoDB data
     results = search_data(sheet_data, email_data, phone_data)
 
     # Update Google Sheet with results
-    update_sheet_with_results(
-        sheets_service, sheet_id, DIGISHEET_WORKSHEET_NAME, results
+    await asyncio.to_thread(
+        update_sheet_with_results,
+        sheets_service,
+        sheet_id,
+        DIGISHEET_WORKSHEET_NAME,
+        results,
     )
 
     logging.info("Script execution completed")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
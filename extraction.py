@@ -1,12 +1,21 @@
 import math
 import logging
 import asyncio
-from typing import List, Optional
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Union
 
 import httpx
+import orjson
 from httpx import AsyncClient, Response
 from asynciolimiter import Limiter
-from tenacity import retry, stop_after_attempt, wait_fixed
+from pymongo import UpdateOne
+from tenacity import (
+    RetryError,
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential,
+)
 
 from config.global_variables import (
     API_TOKEN,
@@ -15,7 +24,8 @@ from config.global_variables import (
 )
 from models.data_models import StageStatus, PersonInfo, DealInfo
 from db.get_db import get_database
-from db.data_access_layer import insert_or_update_document
+from db.data_access_layer import build_update_op, bulk_upsert_documents
+from utils.cleaning_data import email_lookup_keys, phone_lookup_keys
 from config.global_variables import LOG_FILE_PATH
 
 # Configure logging
@@ -30,9 +40,46 @@ logging.basicConfig(
 
 TOKEN = {"api_token": API_TOKEN}
 
+PERSONS_URL = "https://api.pipedrive.com/v1/persons"
+PERSONS_PAGE_LIMIT = 500
+
+# Person records by ID. A fallback fetch sits here as a Future while in flight,
+# and a person confirmed missing (404) as None.
+PersonCache = Dict[int, Union[dict, None, "asyncio.Future[Optional[dict]]"]]
+
 # Rate limiter for API requests
 LIMITER = Limiter(50 / 5)
 
+# Network-level failures worth retrying; HTTP 4xx responses are not
+RETRYABLE_TRANSPORT_ERRORS = (
+    httpx.ReadTimeout,
+    httpx.ConnectError,
+    httpx.RemoteProtocolError,
+)
+MAX_RATE_LIMIT_RETRIES = 5
+
+
+def is_retryable_error(exc: BaseException) -> bool:
+    if isinstance(exc, RETRYABLE_TRANSPORT_ERRORS):
+        return True
+    return isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code >= 500
+
+
+# Rate-limited GET that waits out HTTP 429s for as long as Retry-After asks
+async def limited_get(client: AsyncClient, url: str, **kwargs) -> Response:
+    for _ in range(MAX_RATE_LIMIT_RETRIES):
+        await LIMITER.wait()
+        response: Response = await client.get(url, **kwargs)
+        if response.status_code != 429:
+            break
+        try:
+            delay = float(response.headers.get("Retry-After", 2))
+        except ValueError:
+            delay = 2
+        logging.warning(f"Rate limited on {url}, sleeping {delay}s")
+        await asyncio.sleep(delay)
+    return response
+
 
 # Fetch total pages for deal pagination
 def get_total_pages(base_url: str) -> List[str]:
@@ -47,7 +94,8 @@ def get_total_pages(base_url: str) -> List[str]:
         logging.error(f"Error fetching data: {response.status_code} - {response.text}")
         response.raise_for_status()
 
-    total_count = response.json()["additional_data"]["summary"]["total_count"]
+    summary = orjson.loads(response.content)["additional_data"]["summary"]
+    total_count = summary["total_count"]
     total_pages = math.ceil(total_count / 100)
     for p in range(total_pages):
         page = p * 100
@@ -58,13 +106,13 @@ def get_total_pages(base_url: str) -> List[str]:
 
 # Fetch and process deals data
 @retry(
-    stop=stop_after_attempt(3), wait=wait_fixed(300)
-)  # Retry 3 times with 5 minutes (300 seconds) delay
-async def get_deals(deal_url: str, client: AsyncClient, db):
+    stop=stop_after_attempt(5),
+    wait=wait_exponential(multiplier=1, min=2, max=60),
+    retry=retry_if_exception(is_retryable_error),
+)  # Retry transient failures up to 5 times, backing off from 2s to 60s
+async def get_deals(deal_url: str, client: AsyncClient, db, persons_by_id: PersonCache):
     try:
-        await LIMITER.wait()
-
-        response: Response = await client.get(deal_url)
+        response: Response = await limited_get(client, deal_url)
         logging.info(f"URL: {deal_url} ==> Response: {response.status_code}")
 
         if response.status_code != 200:
@@ -73,78 +121,91 @@ async def get_deals(deal_url: str, client: AsyncClient, db):
             )
             response.raise_for_status()
 
-        response_data = response.json().get("data", [])
+        response_data = orjson.loads(response.content).get("data", [])
         if not response_data:
             logging.error(f"No data found for {deal_url}")
             return
 
-        for data in response_data:
-            person_info = await fetch_person_data(data, client)
-            if person_info:
-                await save_data_to_mongodb(data, person_info, client, db)
-            else:
-                logging.warning(
-                    f"Skipping deal {data.get('id')} due to missing person info"
-                )
+        # Process the page's deals concurrently (LIMITER still gates each request),
+        # then flush the upserts as one bulk write per collection
+        page_ops = await asyncio.gather(
+            *[process_deal(data, client, persons_by_id) for data in response_data]
+        )
+        page_ops = [ops for ops in page_ops if ops]
+        person_ops = [person_op for person_op, _ in page_ops]
+        deal_ops = [deal_op for _, deal_op in page_ops]
+
+        await asyncio.gather(
+            bulk_upsert_documents(db[PERSONS_COLLECTION], person_ops),
+            bulk_upsert_documents(db[DEALS_COLLECTION], deal_ops),
+        )
     except httpx.ReadTimeout:
         logging.warning(
-            f"ReadTimeout occurred while fetching deals for {data.get('id')}. Retrying..."
+            f"ReadTimeout occurred while fetching deals for {deal_url}. Retrying..."
         )
         raise  # Re-raise the exception to trigger retry
 
 
-# Fetch person-related data
+# Load every person once, in pages of PERSONS_PAGE_LIMIT, keyed by person ID
 @retry(
-    stop=stop_after_attempt(3), wait=wait_fixed(300)
-)  # Retry 3 times with 5 minutes (300 seconds) delay
-async def fetch_person_data(data: dict, client: AsyncClient) -> Optional[PersonInfo]:
-    person_id = data.get("person_id")
-    if not person_id:
-        logging.error(f"Person ID missing in deal data {data['id']}.")
-        return None
+    stop=stop_after_attempt(5),
+    wait=wait_exponential(multiplier=1, min=2, max=60),
+    retry=retry_if_exception(is_retryable_error),
+)  # Retry transient failures up to 5 times, backing off from 2s to 60s
+async def load_persons(client: AsyncClient) -> PersonCache:
+    persons_by_id = {}
+    start = 0
+    while True:
+        response: Response = await limited_get(
+            client, PERSONS_URL, params={"start": start, "limit": PERSONS_PAGE_LIMIT}
+        )
+        logging.info(f"URL: {PERSONS_URL}?start={start} ==> {response.status_code}")
 
-    # Check if person_id is a dictionary and has a 'value' key
-    if isinstance(person_id, dict):
-        person_id = person_id.get("value")
+        if response.status_code != 200:
+            logging.error(
+                f"Error fetching data: {response.status_code} - {response.text}"
+            )
+            response.raise_for_status()
 
-    if not person_id:
-        logging.error(f"Invalid person ID format in deal data {data['id']}.")
-        return None
+        payload = orjson.loads(response.content)
+        for person in payload.get("data") or []:
+            persons_by_id[person["id"]] = person
+
+        pagination = (payload.get("additional_data") or {}).get("pagination", {})
+        if not pagination.get("more_items_in_collection"):
+            break
+        start = pagination["next_start"]
+
+    logging.info(f"Loaded {len(persons_by_id)} persons")
+    return persons_by_id
 
-    person_endpoint = f"https://api.pipedrive.com/v1/persons/{person_id}"
+
+# Fetch a single person (fallback for persons missing from the bulk load)
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential(multiplier=1, min=2, max=60),
+    retry=retry_if_exception(is_retryable_error),
+)  # Retry transient failures up to 5 times, backing off from 2s to 60s
+async def fetch_person_record(person_id: int, client: AsyncClient) -> Optional[dict]:
+    person_endpoint = f"{PERSONS_URL}/{person_id}"
     logging.info(f"Fetching Person Data: {person_endpoint}")
     try:
-        await LIMITER.wait()
-        person_response = await client.get(person_endpoint)
+        person_response = await limited_get(client, person_endpoint)
 
-        person_data = person_response.json().get("data", {})
+        if person_response.status_code == 404:
+            logging.error(f"Person not found: {person_endpoint}")
+            return None
+        if person_response.status_code != 200:
+            logging.error(
+                f"Error fetching data: {person_response.status_code} - {person_response.text}"
+            )
+            person_response.raise_for_status()
+
+        person_data = orjson.loads(person_response.content).get("data", {})
         if not person_data:
             logging.error(f"Failed to fetch person info for {person_endpoint}")
             return None
-
-        benefit_id = person_data.get(
-            "ca8fd59fb797a92665b29c4ee38a45524a6ad51b"
-        ) or person_data.get("a1a2bdea3ec02b42cc9baa376fd5ac79a750813b")
-
-        phone_number = ", ".join(
-            [
-                ph.get("value", "").replace("-", "")
-                for ph in person_data.get("phone", [])
-                if ph
-            ]
-        )
-
-        person_info = PersonInfo(
-            id=str(person_id),
-            benefit_id=benefit_id,
-            phone_number=phone_number,
-            email=", ".join(
-                [email.get("value", "") for email in person_data.get("email", [])]
-            ),
-            address=get_person_address(person_data),
-        )
-
-        return person_info
+        return person_data
     except httpx.ReadTimeout:
         logging.warning(
             f"ReadTimeout occurred while fetching person data for {person_id}. Retrying..."
@@ -152,6 +213,89 @@ async def fetch_person_data(data: dict, client: AsyncClient) -> Optional[PersonI
         raise  # Re-raise the exception to trigger retry
 
 
+# Look up a person, fetching it if the bulk load missed it. The in-flight fetch is
+# stored in persons_by_id so concurrent deals for the same person share it, then
+# replaced by the record (or None for a confirmed 404). Failed fetches are dropped,
+# skipping the deal, so a later deal tries again.
+async def lookup_person(
+    person_id: int, client: AsyncClient, persons_by_id: PersonCache
+) -> Optional[dict]:
+    if person_id not in persons_by_id:
+        persons_by_id[person_id] = asyncio.ensure_future(
+            fetch_person_record(person_id, client)
+        )
+    person = persons_by_id[person_id]
+    if not isinstance(person, asyncio.Future):
+        return person
+
+    try:
+        # Shielded so one cancelled deal doesn't cancel the fetch for the others
+        person_data = await asyncio.shield(person)
+    except RetryError:
+        if persons_by_id.get(person_id) is person:
+            del persons_by_id[person_id]
+        logging.error(f"Giving up on person {person_id} for now after retries")
+        return None
+    except httpx.HTTPStatusError as e:
+        # Not worth retrying (e.g. 403, or still rate limited), but only this
+        # deal is affected; skip it rather than failing the whole page
+        if persons_by_id.get(person_id) is person:
+            del persons_by_id[person_id]
+        logging.error(f"Skipping person {person_id}: {e}")
+        return None
+    except Exception:
+        if persons_by_id.get(person_id) is person:
+            del persons_by_id[person_id]
+        raise
+
+    persons_by_id[person_id] = person_data
+    return person_data
+
+
+# Fetch person-related data
+async def fetch_person_data(
+    data: dict, client: AsyncClient, persons_by_id: PersonCache
+) -> Optional[PersonInfo]:
+    person_id = data.get("person_id")
+    if not person_id:
+        logging.error(f"Person ID missing in deal data {data['id']}.")
+        return None
+
+    # Check if person_id is a dictionary and has a 'value' key
+    if isinstance(person_id, dict):
+        person_id = person_id.get("value")
+
+    if not person_id:
+        logging.error(f"Invalid person ID format in deal data {data['id']}.")
+        return None
+
+    person_data = await lookup_person(person_id, client, persons_by_id)
+    if not person_data:
+        return None
+
+    benefit_id = person_data.get(
+        "ca8fd59fb797a92665b29c4ee38a45524a6ad51b"
+    ) or person_data.get("a1a2bdea3ec02b42cc9baa376fd5ac79a750813b")
+
+    phone_number = ", ".join(
+        [
+            ph.get("value", "").replace("-", "")
+            for ph in person_data.get("phone", [])
+            if ph
+        ]
+    )
+
+    return PersonInfo(
+        id=str(person_id),
+        benefit_id=benefit_id,
+        phone_number=phone_number,
+        email=", ".join(
+            [email.get("value", "") for email in person_data.get("email", [])]
+        ),
+        address=get_person_address(person_data),
+    )
+
+
 # Extract address information
 def get_person_address(person_data: dict) -> str:
     address_parts = [
@@ -163,97 +307,108 @@ def get_person_address(person_data: dict) -> str:
     return " ".join(filter(None, address_parts)).strip()
 
 
-async def save_data_to_mongodb(
-    data: dict, person_info: PersonInfo, client: AsyncClient, db
-):
-    deal_id = data["id"]
-    deal_info = await fetch_deal_data(deal_id, client)
-
-    if deal_info:
-        info = {
-            "benefit_id": person_info.benefit_id,
-            "phone_number": person_info.phone_number,
-            "updated_at": data.get("update_time"),
-            "email": person_info.email,
-            "stage_status": (
-                deal_info.stage_status.to_dict() if deal_info.stage_status else None
-            ),
-            "won_lost": deal_info.status,
-            "assigned_to": deal_info.assigned_to,
-            "name": deal_info.name,
-            "address": person_info.address,
-        }
-
-        # Insert or update person data
-        person_collection = db[PERSONS_COLLECTION]
-        person_filter = {"_id": person_info.id}
-        await insert_or_update_document(person_collection, person_filter, info)
-
-        # Insert or update deal data
-        deal_collection = db[DEALS_COLLECTION]
-        deal_filter = {"_id": deal_id}
-        deal_data = {
-            "person_id": person_info.id,
-            "stage_status": (
-                deal_info.stage_status.to_dict() if deal_info.stage_status else None
-            ),
-            "status": deal_info.status,
-            "assigned_to": deal_info.assigned_to,
-            "updated_at": deal_info.updated_at,
-            "name": deal_info.name,
-        }
-        await insert_or_update_document(deal_collection, deal_filter, deal_data)
-
-
-# Fetch deal data
-@retry(
-    stop=stop_after_attempt(3), wait=wait_fixed(300)
-)  # Retry 3 times with 5 minutes (300 seconds) delay
-async def fetch_deal_data(deal_id: str, client: AsyncClient) -> Optional[DealInfo]:
-    deal_endpoint = f"https://api.pipedrive.com/v1/deals/{deal_id}"
-    logging.info(f"Fetching Deal Data: {deal_endpoint}")
-    try:
-        await LIMITER.wait()
-        deal_response = await client.get(deal_endpoint)
+async def process_deal(
+    data: dict, client: AsyncClient, persons_by_id: PersonCache
+) -> Optional[Tuple[UpdateOne, UpdateOne]]:
+    person_info = await fetch_person_data(data, client, persons_by_id)
+    if not person_info:
+        logging.warning(f"Skipping deal {data.get('id')} due to missing person info")
+        return None
 
-        deal_data = deal_response.json().get("data", {})
-        if not deal_data:
-            logging.error(f"Failed to fetch deal info for {deal_endpoint}")
-            return None
+    return build_mongodb_ops(data, person_info, parse_deal_data(data))
 
-        stage_number = deal_data.get("stage_order_nr")
-        stage_status = StageStatus.from_number(stage_number)
-        return DealInfo(
-            id=str(deal_id),
-            person_id=str(deal_data.get("person_id", {}).get("value")),
-            stage_status=stage_status,
-            status=(
-                "WON"
-                if deal_data.get("status") == "won"
-                else "LOST" if deal_data.get("status") == "lost" else ""
-            ),
-            assigned_to=deal_data.get("user_id", {}).get("name"),
-            updated_at=deal_data.get("update_time"),
-            name=deal_data.get("person_id", {}).get("name"),
-        )
-    except httpx.ReadTimeout:
-        logging.warning(
-            f"ReadTimeout occurred while fetching deal data for {deal_id}. Retrying..."
-        )
-        raise  # Re-raise the exception to trigger retry
+
+def build_mongodb_ops(
+    data: dict, person_info: PersonInfo, deal_info: DealInfo
+) -> Tuple[UpdateOne, UpdateOne]:
+    deal_id = data["id"]
+    info = {
+        "benefit_id": person_info.benefit_id,
+        "phone_number": person_info.phone_number,
+        "phone_keys": phone_lookup_keys(person_info.phone_number),
+        "updated_at": deal_info.updated_at,
+        "email": person_info.email,
+        "email_keys": email_lookup_keys(person_info.email),
+        "stage_status": (
+            deal_info.stage_status.description if deal_info.stage_status else None
+        ),
+        "stage_status_value": (
+            deal_info.stage_status.value if deal_info.stage_status else None
+        ),
+        "won_lost": deal_info.status,
+        "assigned_to": deal_info.assigned_to,
+        "name": deal_info.name,
+        "address": person_info.address,
+    }
+
+    # Insert or update person data
+    person_op = build_update_op({"_id": person_info.id}, info)
+
+    # Insert or update deal data
+    deal_data = {
+        "person_id": person_info.id,
+        "stage_status": (
+            deal_info.stage_status.description if deal_info.stage_status else None
+        ),
+        "stage_status_value": (
+            deal_info.stage_status.value if deal_info.stage_status else None
+        ),
+        "status": deal_info.status,
+        "assigned_to": deal_info.assigned_to,
+        "updated_at": deal_info.updated_at,
+        "name": deal_info.name,
+    }
+    deal_op = build_update_op({"_id": deal_id}, deal_data)
+
+    return person_op, deal_op
+
+
+# Pipedrive timestamps are UTC "YYYY-MM-DD HH:MM:SS"; stored as BSON dates
+def parse_update_time(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+# Build deal data from the deals list payload (it already carries these fields)
+def parse_deal_data(data: dict) -> DealInfo:
+    stage_status = StageStatus.from_number(data.get("stage_order_nr"))
+    return DealInfo(
+        id=str(data["id"]),
+        person_id=str((data.get("person_id") or {}).get("value")),
+        stage_status=stage_status,
+        status=(
+            "WON"
+            if data.get("status") == "won"
+            else "LOST" if data.get("status") == "lost" else ""
+        ),
+        assigned_to=(data.get("user_id") or {}).get("name"),
+        updated_at=parse_update_time(data.get("update_time")),
+        name=(data.get("person_id") or {}).get("name"),
+    )
 
 
 async def run():
     try:
-        db = await get_database()
+        db = get_database()
         base_url = (
             "https://shc2.pipedrive.com/api/v1/deals?start=0&limit=100&get_summary=1"
         )
         deal_pages = get_total_pages(base_url)
 
-        async with AsyncClient(params=TOKEN, timeout=30) as client:
+        # HTTP/2 multiplexes the concurrent requests over a few kept-alive connections
+        async with AsyncClient(
+            params=TOKEN,
+            timeout=30,
+            http2=True,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+        ) as client:
+            # Persons are listed in bulk once instead of fetched per deal
+            persons_by_id = await load_persons(client)
+
             # Create a list of tasks for all deal URLs
-            tasks = [get_deals(deal_url, client, db) for deal_url in deal_pages]
+            tasks = [
+                get_deals(deal_url, client, db, persons_by_id)
+                for deal_url in deal_pages
+            ]
 
             # Run all tasks concurrently
             await asyncio.gather(*tasks)
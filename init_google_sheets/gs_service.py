@@ -1,4 +1,6 @@
 import logging
+from datetime import datetime
+from zoneinfo import ZoneInfo
 
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
@@ -8,12 +10,27 @@ from config.global_variables import (
     SCOPES,
 )
 
+_PACIFIC = ZoneInfo("America/Los_Angeles")
+
+
+def load_credentials():
+    """Load the service account credentials."""
+    return Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
+
+
+def build_sheets_service(creds=None):
+    """Build a Sheets service with its own HTTP connection.
+
+    httplib2 isn't thread-safe, so every thread writing to Sheets needs its own.
+    """
+    return build("sheets", "v4", credentials=creds or load_credentials())
+
 
 def initialize_services():
     """Initialize and return Google Sheets and Drive services."""
     logging.info("Initializing Google services")
-    creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
-    sheets_service = build("sheets", "v4", credentials=creds)
+    creds = load_credentials()
+    sheets_service = build_sheets_service(creds)
     drive_service = build("drive", "v3", credentials=creds)
     return sheets_service, drive_service
 
@@ -28,3 +45,27 @@ def get_sheet_id(drive_service, spreadsheet_name):
         raise ValueError(f"No spreadsheet named '{spreadsheet_name}' found.")
     logging.info(f"Sheet ID found: {items[0]['id']}")
     return items[0]["id"]
+
+
+def sheet_timestamp():
+    """Return the current Pacific time formatted for the timestamp column."""
+    return datetime.now(_PACIFIC).strftime("%m/%d/%Y %H:%M:%S")
+
+
+def coalesce_row_ranges(worksheet_name, first_column, last_column, rows):
+    """Merge (row_index, values) pairs into one range per run of consecutive rows."""
+    runs = []
+    for row_index, values in sorted(rows, key=lambda row: row[0]):
+        if runs and row_index == runs[-1][1] + 1:
+            runs[-1][1] = row_index
+            runs[-1][2].append(values)
+        else:
+            runs.append([row_index, row_index, [values]])
+
+    return [
+        {
+            "range": f"'{worksheet_name}'!{first_column}{start}:{last_column}{end}",
+            "values": values,
+        }
+        for start, end, values in runs
+    ]
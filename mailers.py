@@ -1,18 +1,21 @@
+import asyncio
 import logging
-from datetime import datetime
-import pytz
-from pymongo import MongoClient
 
 from utils.cleaning_data import clean_phone
 from config.global_variables import (
     SPREADSHEET_NAME,
     MAILERS_WORKSHEET_NAME,
     MAILERS_RANGE_NAME,
-    MONGO_URI,
-    DB_NAME,
     PERSONS_COLLECTION,
 )
-from init_google_sheets.gs_service import initialize_services, get_sheet_id
+from db.get_db import get_database
+from db.data_access_layer import backfill_lookup_keys
+from init_google_sheets.gs_service import (
+    initialize_services,
+    get_sheet_id,
+    coalesce_row_ranges,
+    sheet_timestamp,
+)
 from config.global_variables import LOG_FILE_PATH
 
 # Logging setup
@@ -25,22 +28,44 @@ logging.basicConfig(
 )
 
 
-def load_mongodb_data():
-    """Load data from MongoDB into a dictionary."""
-    client = MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    collection = db[PERSONS_COLLECTION]
-
+# Only the fields search_data reads, plus the phone lookup keys
+PROJECTION = {
+    "_id": 0,
+    "phone_keys": 1,
+    "benefit_id": 1,
+    # Documents written before stage_status became a plain string still hold
+    # {"value", "description"}; unwrap those on the server
+    "stage_status": {"$ifNull": ["$stage_status.description", "$stage_status"]},
+    "won_lost": 1,
+    "assigned_to": 1,
+    "name": 1,
+    "address": 1,
+    "email": 1,
+}
+
+
+async def ensure_indexes(collection, backfill_keys=True):
+    """Create the phone lookup index, backfilling lookup keys if asked."""
+    # Same key as digisheet's, whose phone_keys prefix serves these lookups, so
+    # the two scripts share one index
+    tasks = [collection.create_index([("phone_keys", 1), ("updated_at", -1)])]
+    if backfill_keys:
+        tasks.append(backfill_lookup_keys(collection))
+    await asyncio.gather(*tasks)
+
+
+async def fetch_matches(collection, phones):
+    """Fetch the MongoDB persons matching the given phones into a dictionary."""
     phone_dict = {}
-    for doc in collection.find():
-        phone_numbers = doc.get("phone_number", "").split(", ")
-        for phone in phone_numbers:
-            cleaned_phone = clean_phone(phone)
-            if cleaned_phone:
-                phone_dict[cleaned_phone] = doc
-                logging.info(f"Loaded data for phone: {cleaned_phone}")
-            else:
-                logging.warning(f"Invalid phone number in document: {phone}")
+    cursor = collection.find(
+        {"phone_keys": {"$in": list(phones)}}, PROJECTION, batch_size=1000
+    )
+    async for doc in cursor:
+        # The keys are only needed for indexing; don't keep them per match
+        for phone in doc.pop("phone_keys", []):
+            if phone in phones:
+                phone_dict[phone] = doc
+                logging.debug("Loaded data for phone: %s", phone)
 
     logging.info(f"Total loaded phone records: {len(phone_dict)}")
     return phone_dict
@@ -51,17 +76,16 @@ def search_data(sheet_data, phone_data):
     results = []
     for row_data in sheet_data:
         phone = row_data["phone_number"]
-        logging.info(f"Searching for phone: {phone}")
         match = phone_data.get(phone)
 
-        if match:
-            logging.info(f"Match found for phone: {phone}")
+        if match is not None:
+            logging.debug("Match found for phone: %s", phone)
             results.append(
                 {
                     "row": row_data["row"],
                     "benefit_id": match.get("benefit_id", ""),
-                    "stage_status": extract_description(match.get("stage_status", "")),
-                    "won/lost": extract_description(match.get("won_lost", "")),
+                    "stage_status": match.get("stage_status", ""),
+                    "won/lost": match.get("won_lost", ""),
                     "assigned_to": match.get("assigned_to", ""),
                     "name": match.get("name", ""),
                     "address": match.get("address", ""),
@@ -69,7 +93,7 @@ def search_data(sheet_data, phone_data):
                 }
             )
         else:
-            logging.info(f"No match found for phone: {phone}")
+            logging.debug("No match found for phone: %s", phone)
             results.append(
                 {
                     "row": row_data["row"],
@@ -92,13 +116,6 @@ def search_data(sheet_data, phone_data):
     return results
 
 
-def extract_description(value):
-    """Extract description from complex structures or return the value as is."""
-    if isinstance(value, dict) and "description" in value:
-        return value["description"]
-    return value
-
-
 def batch_get_values(service, spreadsheet_id, ranges):
     """Batch get values from multiple ranges in the sheet."""
     request = (
@@ -109,61 +126,66 @@ def batch_get_values(service, spreadsheet_id, ranges):
     return request.execute().get("valueRanges", [])
 
 
+def format_cell(value):
+    """Convert a value to the string written to the sheet (None becomes empty)."""
+    return "" if value is None else str(value)
+
+
 def update_sheet_with_results(sheets_service, sheet_id, worksheet_name, results):
     """Update the Google Sheet with the search results."""
     logging.info("Updating sheet with results")
-    now = datetime.now(tz=pytz.utc).astimezone(pytz.timezone("US/Pacific"))
-    dt_string = now.strftime("%m/%d/%Y %H:%M:%S")
-
-    batch_data = []
-    for result in results:
-        row_index = result["row"]
-        values = [
-            dt_string,
-            result["benefit_id"],
-            result["stage_status"],
-            result["won/lost"],
-            result["assigned_to"],
-            result["name"],
-            result["address"],
-            result["email"],
-        ]
-        # Convert any non-string values to strings and handle None values
-        values = [str(value) if value is not None else "" for value in values]
-        batch_data.append(
-            {
-                "range": f"'{worksheet_name}'!C{row_index}:J{row_index}",
-                "values": [values],
-            }
+    dt_string = sheet_timestamp()
+
+    rows = [
+        (
+            result["row"],
+            [
+                dt_string,
+                format_cell(result["benefit_id"]),
+                format_cell(result["stage_status"]),
+                format_cell(result["won/lost"]),
+                format_cell(result["assigned_to"]),
+                format_cell(result["name"]),
+                format_cell(result["address"]),
+                format_cell(result["email"]),
+            ],
         )
+        for result in results
+    ]
+
+    # Consecutive rows share a single range to keep the request small
+    batch_data = coalesce_row_ranges(worksheet_name, "C", "J", rows)
 
     if batch_data:
         body = {"valueInputOption": "RAW", "data": batch_data}
         sheets_service.spreadsheets().values().batchUpdate(
             spreadsheetId=sheet_id, body=body
         ).execute()
-        logging.info(f"Updated {len(batch_data)} rows with new data")
+        logging.info(
+            f"Updated {len(rows)} rows with new data in {len(batch_data)} ranges"
+        )
     else:
         logging.info("No updates to perform")
 
 
-def main():
+async def main(backfill_keys=True):
     logging.info("Starting script execution")
 
     # Initialize services
     sheets_service, drive_service = initialize_services()
 
     # Get sheet ID
-    sheet_id = get_sheet_id(drive_service, SPREADSHEET_NAME)
-
-    # Load MongoDB data
-    phone_data = load_mongodb_data()
-    logging.info(f"Loaded {len(phone_data)} phone records")
-    logging.info(f"Sample of loaded phone numbers: {list(phone_data.keys())[:5]}")
+    sheet_id = await asyncio.to_thread(get_sheet_id, drive_service, SPREADSHEET_NAME)
 
-    # Batch get values from the sheet
+    # Batch get values from the sheet while the lookup index is ensured
+    # (the Sheets client is blocking, so it runs in a worker thread)
+    db = get_database()
+    collection = db[PERSONS_COLLECTION]
     ranges = [f"'{MAILERS_WORKSHEET_NAME}'!{MAILERS_RANGE_NAME}"]
-    batch_data = batch_get_values(sheets_service, sheet_id, ranges)
+    _, batch_data = await asyncio.gather(
+        ensure_indexes(collection, backfill_keys),
+        asyncio.to_thread(batch_get_values, sheets_service, sheet_id, ranges),
+    )
 
     # Process sheet data
     sheet_data = []
@@ -179,21 +201,32 @@ def main():
                             "phone_number": phone,
                         }
                     )
-                    logging.info(f"Processed phone from sheet: {phone}")
+                    logging.debug("Processed phone from sheet: %s", phone)
 
     logging.info(f"Processed {len(sheet_data)} rows from the sheet")
     logging.info(
         f"Sample of processed phone numbers: {[d['phone_number'] for d in sheet_data[:5]]}"
     )
 
+    # Load only the MongoDB persons referenced by the sheet
+    phones_to_lookup = {row["phone_number"] for row in sheet_data}
+    phone_data = await fetch_matches(collection, phones_to_lookup)
+    logging.info(f"Loaded {len(phone_data)} phone records")
+
     # Search for matches
     results = search_data(sheet_data, phone_data)
 
     # Update Google Sheet with results
-    update_sheet_with_results(sheets_service, sheet_id, MAILERS_WORKSHEET_NAME, results)
+    await asyncio.to_thread(
+        update_sheet_with_results,
+        sheets_service,
+        sheet_id,
+        MAILERS_WORKSHEET_NAME,
+        results,
+    )
 
     logging.info("Script execution completed")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -2,7 +2,9 @@ import logging
 
 import asyncio
 
-from config.global_variables import LOG_FILE_PATH
+from config.global_variables import LOG_FILE_PATH, PERSONS_COLLECTION
+from db.get_db import get_database
+from db.data_access_layer import backfill_lookup_keys
 
 
 from extraction import run as extract_data
@@ -18,9 +20,19 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
+
+async def run_all():
+    await extract_data()
+    # Backfill the lookup keys once here rather than in both updaters that use them
+    await backfill_lookup_keys(get_database()[PERSONS_COLLECTION])
+    # The updaters write disjoint worksheets and only read MongoDB
+    await asyncio.gather(
+        mailers_sheet_update(backfill_keys=False),
+        purls_sheet_update(),
+        digisheet_sheet_update(backfill_keys=False),
+    )
+
+
 logging.info("Cron job script started.")
 
-asyncio.run(extract_data())
-mailers_sheet_update()
-purls_sheet_update()
-digisheet_sheet_update()
+asyncio.run(run_all())
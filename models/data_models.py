@@ -1,8 +1,21 @@
+from datetime import datetime
 from enum import Enum
 from typing import Optional
 from pydantic import BaseModel
 
 
+_STAGE_DESCRIPTIONS = {
+    0: "Trying to Contact",
+    1: "Took App",
+    2: "Rec Docs - Lender Call",
+    3: "Financial Sched",
+    4: "Compliance Shed",
+    5: "Pending Payment",
+    6: "PAID",
+    7: "Sub'd to Processing",
+}
+
+
 class StageStatus(Enum):
     TRYING_TO_CONTACT = 0
     TOOK_APP = 1
@@ -15,26 +28,23 @@ class StageStatus(Enum):
 
     @property
     def description(self):
-        descriptions = {
-            0: "Trying to Contact",
-            1: "Took App",
-            2: "Rec Docs - Lender Call",
-            3: "Financial Sched",
-            4: "Compliance Shed",
-            5: "Pending Payment",
-            6: "PAID",
-            7: "Sub'd to Processing",
-        }
-        return descriptions[self.value]
+        return _STAGE_DESCRIPTIONS[self.value]
 
     @classmethod
     def from_number(cls, number):
-        return cls(number)
+        try:
+            return _STAGES_BY_NUMBER[number]
+        except (KeyError, TypeError):
+            raise ValueError(f"{number!r} is not a valid {cls.__name__}") from None
 
     def to_dict(self):
         return {"value": self.value, "description": self.description}
 
 
+# Built once; from_number is called for every deal
+_STAGES_BY_NUMBER = {stage.value: stage for stage in StageStatus}
+
+
 # Pydantic model for person data
 class PersonInfo(BaseModel):
     id: str
@@ -51,5 +61,5 @@ class DealInfo(BaseModel):
     stage_status: Optional[StageStatus]
     status: str
     assigned_to: Optional[str] = None
-    updated_at: Optional[str] = None
+    updated_at: Optional[datetime] = None
     name: Optional[str] = None
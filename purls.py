@@ -1,18 +1,23 @@
+import asyncio
 import logging
-from datetime import datetime
-import pytz
-from pymongo import MongoClient
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from utils.cleaning_data import clean_benefit_id
 from config.global_variables import (
     SPREADSHEET_NAME,
     PURLS_WORKSHEET_NAME,
     PURLS_RANGE_NAME,
-    MONGO_URI,
-    DB_NAME,
     PERSONS_COLLECTION,
 )
-from init_google_sheets.gs_service import initialize_services, get_sheet_id
+from db.get_db import get_database
+from init_google_sheets.gs_service import (
+    initialize_services,
+    build_sheets_service,
+    get_sheet_id,
+    coalesce_row_ranges,
+    sheet_timestamp,
+)
 from config.global_variables import LOG_FILE_PATH
 
 # Logging setup
@@ -25,72 +30,125 @@ logging.basicConfig(
 )
 
 
-def load_mongodb_data():
-    """Load data from MongoDB into a dictionary."""
-    client = MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    collection = db[PERSONS_COLLECTION]
+# Only the fields search_data reads. Lookups are keyed on benefit_id, and
+# ensure_indexes builds a compound index over exactly these fields so the
+# find can be answered from the index alone (hence no _id).
+PROJECTION = {
+    "_id": 0,
+    "benefit_id": 1,
+    "phone_number": 1,
+    "email": 1,
+    "stage_status": 1,
+    "won_lost": 1,
+    "assigned_to": 1,
+    "name": 1,
+    "address": 1,
+}
+ID_CHUNK_SIZE = 1000
+
+# Very large updates are written in chunks of rows, a few requests at a time,
+# to stay under the Sheets request size limit. Rate limited (429) and 5xx
+# responses are retried with backoff, as the per-user write quota is per minute.
+WRITE_CHUNK_ROWS = 10000
+WRITE_WORKERS = 4
+WRITE_RETRIES = 5
+
+# Sheets service for each write worker thread (httplib2 isn't thread-safe)
+_worker = threading.local()
+
+# Match fields written to the sheet, in column order (D:J)
+CELL_FIELDS = (
+    "phone_number",
+    "stage_status",
+    "won_lost",
+    "assigned_to",
+    "name",
+    "address",
+    "email",
+)
+
+# Cells (columns D:J) written for sheet rows with no matching person
+NA_CELLS = ["N/A"] * 7
+
+
+async def ensure_indexes(collection):
+    """Create the covering index for the benefit ID lookups (no-op if present)."""
+    # benefit_id leads, so this also serves as the plain lookup index
+    await collection.create_index(
+        [(field, 1) for field in PROJECTION if field != "_id"], name="purls_cover"
+    )
+
+
+def flatten_stage_status(doc):
+    """Unwrap a legacy {"value", "description"} stage_status to its description.
+
+    Always leaves a str in the doc, so the sheet cell needs no conversion.
+    """
+    stage_status = doc.get("stage_status")
+    if isinstance(stage_status, dict):
+        stage_status = stage_status.get("description")
+    doc["stage_status"] = "" if stage_status is None else str(stage_status)
+    return doc
 
+
+async def load_benefit_chunk(collection, benefit_ids):
+    """Load the MongoDB persons for one chunk of benefit IDs."""
+    cursor = collection.find({"benefit_id": {"$in": benefit_ids}}, PROJECTION)
+    return {
+        doc["benefit_id"]: flatten_stage_status(doc)
+        async for doc in cursor.batch_size(2000)
+    }
+
+
+async def load_mongodb_data(collection, benefit_ids):
+    """Load the MongoDB persons for the given benefit IDs into a dictionary."""
+    # Chunked so a very large sheet doesn't build an oversized $in query; the
+    # chunks are fetched concurrently over the shared connection pool
+    parts = await asyncio.gather(
+        *[
+            load_benefit_chunk(collection, benefit_ids[start : start + ID_CHUNK_SIZE])
+            for start in range(0, len(benefit_ids), ID_CHUNK_SIZE)
+        ]
+    )
     benefit_dict = {}
-    for doc in collection.find():
-        benefit_id = doc.get("benefit_id", "")
-        if benefit_id:
-            benefit_dict[benefit_id] = doc
-            logging.info(f"Loaded data for benefit ID: {benefit_id}")
-        else:
-            logging.warning(f"Invalid benefit ID in file {benefit_id}")
+    for part in parts:
+        benefit_dict.update(part)
 
     logging.info(f"Total loaded benefit ID records: {len(benefit_dict)}")
     return benefit_dict
 
 
+def sheet_cells(benefit_id, benefit_data):
+    """Build the D:J cells for one benefit ID."""
+    match = benefit_data.get(benefit_id)
+    if not match:
+        logging.debug("No match found for benefit ID: %s", benefit_id)
+        return NA_CELLS
+
+    logging.debug("Match found for benefit ID: %s", benefit_id)
+    # Most values are already str; only convert the ones that aren't
+    return [
+        "" if v is None else v if type(v) is str else str(v)
+        for v in map(match.get, CELL_FIELDS)
+    ]
+
+
 def search_data(sheet_data, benefit_data):
-    """Search for matches in the loaded data."""
-    results = []
-    for row_data in sheet_data:
-        benefit_id = row_data["benefit_id"]
-        logging.info(f"Searching for benefit ID: {benefit_id}")
-        match = benefit_data.get(benefit_id)
-
-        if match:
-            logging.info(f"Match found for benefit ID: {benefit_id}")
-            results.append(
-                {
-                    "row": row_data["row"],
-                    "phone_number": match.get("phone_number", ""),
-                    "email": match.get("email", ""),
-                    "stage_status": extract_description(match.get("stage_status", "")),
-                    "won/lost": extract_description(match.get("won/lost", "")),
-                    "assigned_to": match.get("assigned_to", ""),
-                    "name": match.get("name", ""),
-                    "address": match.get("address", ""),
-                }
-            )
-        else:
-            logging.info(f"No match found for benefit ID: {benefit_id}")
-            results.append(
-                {
-                    "row": row_data["row"],
-                    "phone_number": "N/A",
-                    "email": "N/A",
-                    "stage_status": "N/A",
-                    "won/lost": "N/A",
-                    "assigned_to": "N/A",
-                    "name": "N/A",
-                    "address": "N/A",
-                }
-            )
-
-    matches_found = sum(1 for r in results if r["phone_number"] != "N/A")
-    logging.info(f"Total results: {len(results)}, Matches found: {matches_found}")
-    return results
-
-
-def extract_description(value):
-    """Extract description from complex structures or return the value as is."""
-    if isinstance(value, dict) and "description" in value:
-        return value["description"]
-    return value
+    """Yield (row, cells) for each sheet row, straight from the loaded data."""
+    # Duplicate benefit IDs on the sheet reuse the cells built for the first one
+    cells_by_id = {}
+    cells_by_id_get = cells_by_id.get
+    total = matches_found = 0
+    for row_index, benefit_id in sheet_data:
+        total += 1
+        cells = cells_by_id_get(benefit_id)
+        if cells is None:
+            cells = cells_by_id[benefit_id] = sheet_cells(benefit_id, benefit_data)
+        if cells is not NA_CELLS:
+            matches_found += 1
+        yield row_index, cells
+
+    logging.info(f"Total results: {total}, Matches found: {matches_found}")
 
 
 def batch_get_values(service, spreadsheet_id, ranges):
@@ -103,60 +161,103 @@ def batch_get_values(service, spreadsheet_id, ranges):
     return request.execute().get("valueRanges", [])
 
 
-def update_sheet_with_results(sheets_service, sheet_id, worksheet_name, results):
-    """Update the Google Sheet with the search results."""
+def write_ranges(sheets_service, sheet_id, batch_data):
+    """Write coalesced ranges to the sheet in a single request."""
+    values = sheets_service.spreadsheets().values()
+    if len(batch_data) == 1:
+        # One contiguous block: a plain values.update is enough
+        values.update(
+            spreadsheetId=sheet_id,
+            range=batch_data[0]["range"],
+            valueInputOption="RAW",
+            body={"values": batch_data[0]["values"]},
+        ).execute(num_retries=WRITE_RETRIES)
+    else:
+        body = {"valueInputOption": "RAW", "data": batch_data}
+        values.batchUpdate(spreadsheetId=sheet_id, body=body).execute(
+            num_retries=WRITE_RETRIES
+        )
+
+
+def write_chunk(sheet_id, batch_data):
+    """Write one chunk from a worker thread, using that thread's Sheets service."""
+    if not hasattr(_worker, "sheets_service"):
+        _worker.sheets_service = build_sheets_service()
+    write_ranges(_worker.sheets_service, sheet_id, batch_data)
+
+
+def is_unchanged(cells, current):
+    """Whether a row's D:J cells already match its current C:J values on the sheet."""
+    # The sheet trims trailing empty cells, so pad before comparing
+    existing = current[1:]
+    return existing + [""] * (len(cells) - len(existing)) == cells
+
+
+def update_sheet_with_results(
+    sheets_service, sheet_id, worksheet_name, results, existing_rows
+):
+    """Update the Google Sheet with the search results.
+
+    Rows whose values match existing_rows (C:J values keyed by row number) are
+    left alone, timestamp included.
+    """
     logging.info("Updating sheet with results")
-    now = datetime.now(tz=pytz.utc).astimezone(pytz.timezone("US/Pacific"))
-    dt_string = now.strftime("%m/%d/%Y %H:%M:%S")
-
-    batch_data = []
-    for result in results:
-        row_index = result["row"]
-        values = [
-            dt_string,
-            result["phone_number"],
-            result["stage_status"],
-            result["won/lost"],
-            result["assigned_to"],
-            result["name"],
-            result["address"],
-            result["email"],
-        ]
-        # Convert any non-string values to strings and handle None values
-        values = [str(value) if value is not None else "" for value in values]
-        batch_data.append(
-            {
-                "range": f"'{worksheet_name}'!C{row_index}:J{row_index}",
-                "values": [values],
-            }
+    dt_string = sheet_timestamp()
+
+    # Cells arrive already coerced to str by search_data
+    existing_get = existing_rows.get
+    rows = []
+    skipped = 0
+    for row_index, cells in results:
+        current = existing_get(row_index)
+        if current and is_unchanged(cells, current):
+            skipped += 1
+            continue
+        rows.append((row_index, [dt_string, *cells]))
+    logging.info(f"Skipping {skipped} unchanged rows")
+
+    # Consecutive rows within a chunk share a single range
+    chunks = [
+        coalesce_row_ranges(
+            worksheet_name, "C", "J", rows[start : start + WRITE_CHUNK_ROWS]
         )
+        for start in range(0, len(rows), WRITE_CHUNK_ROWS)
+    ]
 
-    if batch_data:
-        body = {"valueInputOption": "RAW", "data": batch_data}
-        sheets_service.spreadsheets().values().batchUpdate(
-            spreadsheetId=sheet_id, body=body
-        ).execute()
-        logging.info(f"Updated {len(batch_data)} rows with new data")
-    else:
+    if not chunks:
         logging.info("No updates to perform")
+        return
 
+    if len(chunks) == 1:
+        write_ranges(sheets_service, sheet_id, chunks[0])
+    else:
+        with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as executor:
+            list(executor.map(write_chunk, [sheet_id] * len(chunks), chunks))
 
-def main():
+    logging.info(
+        f"Updated {len(rows)} rows with new data in "
+        f"{sum(map(len, chunks))} ranges over {len(chunks)} requests"
+    )
+
+
+async def main():
     logging.info("Starting script execution")
 
     # Initialize services
     sheets_service, drive_service = initialize_services()
 
     # Get sheet ID
-    sheet_id = get_sheet_id(drive_service, SPREADSHEET_NAME)
+    sheet_id = await asyncio.to_thread(get_sheet_id, drive_service, SPREADSHEET_NAME)
 
-    # Load JSON data
-    benefit_data = load_mongodb_data()
-    logging.info(f"Loaded {len(benefit_data)} benefit ID records")
-
-    # Batch get values from the sheet
+    # Batch get values from the sheet while the lookup index is ensured
+    # (the Sheets client is blocking, so it runs in a worker thread)
+    db = get_database()
+    collection = db[PERSONS_COLLECTION]
     ranges = [f"'{PURLS_WORKSHEET_NAME}'!{PURLS_RANGE_NAME}"]
-    batch_data = batch_get_values(sheets_service, sheet_id, ranges)
+    _, batch_data = await asyncio.gather(
+        ensure_indexes(collection),
+        asyncio.to_thread(batch_get_values, sheets_service, sheet_id, ranges),
+    )
 
     # Process sheet data
     sheet_data = []
@@ -166,24 +267,45 @@ def main():
             if len(row) > 1:
                 benefit_id = clean_benefit_id(row[1])
                 if benefit_id:
-                    sheet_data.append(
-                        {
-                            "row": i,
-                            "benefit_id": benefit_id,
-                        }
-                    )
-                    logging.info(f"Processed benefit ID from sheet: {benefit_id}")
+                    sheet_data.append((i, benefit_id))
+                    logging.debug("Processed benefit ID from sheet: %s", benefit_id)
 
     logging.info(f"Processed {len(sheet_data)} rows from the sheet")
+    if not sheet_data:
+        logging.info("No benefit IDs on the sheet, nothing to update")
+        return
+
+    # Load only the MongoDB persons referenced by the sheet, once per ID
+    # (human-edited sheets often repeat them). The current output columns
+    # are read alongside, so rows that haven't changed aren't rewritten.
+    unique_ids = {benefit_id for _, benefit_id in sheet_data}
+    max_row = sheet_data[-1][0]
+    output_ranges = [f"'{PURLS_WORKSHEET_NAME}'!C2:J{max_row}"]
+    benefit_data, output_data = await asyncio.gather(
+        load_mongodb_data(collection, list(unique_ids)),
+        asyncio.to_thread(batch_get_values, sheets_service, sheet_id, output_ranges),
+    )
+    logging.info(f"Loaded {len(benefit_data)} benefit ID records")
+
+    existing_rows = {}
+    if output_data:
+        existing_rows = dict(enumerate(output_data[0].get("values", []), start=2))
 
-    # Search for matches
+    # Search for matches; consumed lazily while the update is built
     results = search_data(sheet_data, benefit_data)
 
     # Update Google Sheet with results
-    update_sheet_with_results(sheets_service, sheet_id, PURLS_WORKSHEET_NAME, results)
+    await asyncio.to_thread(
+        update_sheet_with_results,
+        sheets_service,
+        sheet_id,
+        PURLS_WORKSHEET_NAME,
+        results,
+        existing_rows,
+    )
 
     logging.info("Script execution completed")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -1,29 +1,55 @@
 import re
+from typing import List, Optional
 
+_EMAIL_RE = re.compile(r"[^@]+@[^@]+\.[^@]+")
+_NON_DIGITS_RE = re.compile(r"\D")
+# Deletes every non-digit ASCII character in a single C-level pass
+_DELETE_ASCII_NON_DIGITS = str.maketrans(
+    "", "", "".join(chr(c) for c in range(128) if not chr(c).isdigit())
+)
 
-def clean_phone(phone):
+
+def clean_phone(phone: Optional[str]) -> Optional[str]:
     """Clean and validate phone number."""
     if not phone:
         return None
-    phone = re.sub(r"\D", "", phone)
+    if phone.isascii():
+        phone = phone.translate(_DELETE_ASCII_NON_DIGITS)
+    else:
+        phone = _NON_DIGITS_RE.sub("", phone)
     return phone if len(phone) >= 10 else None
 
 
-def clean_email(email):
+def clean_email(email: Optional[str]) -> Optional[str]:
     """Clean and validate email address."""
     if not email:
         return None
     email = email.strip()
-    email_regex = re.compile(r"[^@]+@[^@]+\.[^@]+")
-    return email if email_regex.match(email) else None
+    return email if _EMAIL_RE.match(email) else None
+
+
+def phone_lookup_keys(phone_numbers: Optional[str]) -> List[str]:
+    """Split a comma-separated phone string into cleaned lookup keys."""
+    if not phone_numbers:
+        return []
+    return [phone for phone in map(clean_phone, phone_numbers.split(", ")) if phone]
+
+
+def email_lookup_keys(emails: Optional[str]) -> List[str]:
+    """Split a comma-separated email string into cleaned lookup keys."""
+    if not emails:
+        return []
+    return [email for email in map(clean_email, emails.split(", ")) if email]
 
 
-def clean_benefit_id(benefit_id):
+def clean_benefit_id(benefit_id: object) -> str:
     """Clean and validate benefit ID by removing 'PURL' and other unnecessary characters."""
-    # Strip leading/trailing whitespaces
-    benefit_id = str(benefit_id).strip()
+    if benefit_id is None:
+        return ""
+    # Strip leading/trailing whitespaces (sheet cells already arrive as str)
+    if isinstance(benefit_id, str):
+        cleaned = benefit_id.strip()
+    else:
+        cleaned = str(benefit_id).strip()
     # Remove the 'PURL' prefix if it exists
-    if benefit_id.startswith("PURL "):
-        benefit_id = benefit_id.replace("PURL ", "")
-    # Further cleaning (e.g., if you have other prefixes to remove, adjust here)
-    return benefit_id
+    return cleaned.removeprefix("PURL ")